@@ -1,154 +1,637 @@
+import atexit
+import hashlib
 import json
 import boto3
 import os
-from typing import Dict, List
+from typing import Any, Callable, Deque, Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
+from botocore.config import Config
 from botocore.exceptions import ClientError
-from collections import defaultdict
+from collections import OrderedDict, defaultdict, deque
+from decimal import Decimal
 import logging
+import queue
+import threading
+import random
+import time
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 
 # Configure logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-# AWS clients
-dynamodb = boto3.resource('dynamodb', region_name=os.getenv('AWS_DEFAULT_REGION'))
-sqs = boto3.client('sqs', region_name=os.getenv('AWS_DEFAULT_REGION'))
+# Environment configuration, read once per container
+REGION = os.getenv('AWS_DEFAULT_REGION')
+QUEUE_URL = os.getenv("QUEUE_URL")
+MESSAGE_GROUP_ID = os.getenv("MESSAGE_GROUP_ID", "documents")
+
+def _encode_default(value: Any) -> Any:
+    """Encodes the numbers and sets DynamoDB returns, so they hash like their JSON equivalents"""
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def _positive_int(name: str, default: int) -> int:
+    """Reads a setting that must be at least 1 from the environment"""
+    value = int(os.getenv(name, str(default)))
+    if value < 1:
+        raise ValueError(f"{name} must be at least 1, got {value}")
+    return value
+
+# Reusable JSON encoders for message bodies and document hashes
+_encode = json.JSONEncoder(separators=(',', ':')).encode
+_encode_canonical = json.JSONEncoder(sort_keys=True, separators=(',', ':'), default=_encode_default).encode
+
+# AWS clients are created on first use to keep cold starts short
+@lru_cache(maxsize=None)
+def _dynamodb():
+    # Adaptive retries rate-limit the client when DynamoDB starts throttling
+    config = Config(retries={'max_attempts': 10, 'mode': 'adaptive'})
+    return boto3.resource('dynamodb', region_name=REGION, config=config)
+
+@lru_cache(maxsize=None)
+def _sqs():
+    return boto3.client('sqs', region_name=REGION)
+
+# Buffered match writes are flushed early once this many are pending,
+# which bounds memory without splitting a typical SQS batch
+MAX_BUFFERED_WRITES = 1000
+
+# Matched documents are appended in chunks of at most this many encoded bytes,
+# so that any chunk fits in an empty item under DynamoDB's 400KB item limit
+MAX_APPEND_BYTES = 350 * 1024
+
+# Largest item DynamoDB stores, so a bigger document can never be stored as a match
+MAX_ITEM_BYTES = 400 * 1024
+
+# Times one append moves on to a newer shard of a matched list before giving up
+MAX_SHARD_ADVANCES = 3
+
+# SQS accepts at most 10 entries, and 256KB of message bodies, per SendMessageBatch request
+SQS_BATCH_SIZE = 10
+SQS_BATCH_BYTES = 256 * 1024
+MAX_SEND_ATTEMPTS = 5
+
+# Longest a buffered message waits for its batch to fill before being sent
+SQS_BUFFER_SECONDS = 0.2
+
+# BatchWriteItem accepts at most 25 items per request
+BATCH_WRITE_SIZE = 25
+MAX_WRITE_ATTEMPTS = 8
+
+# Error codes DynamoDB returns when a request is throttled and can be retried
+RETRYABLE_WRITE_ERRORS = {"ProvisionedThroughputExceededException", "ThrottlingException", "RequestLimitExceeded"}
+
+# Exponential backoff between retries, in seconds
+BACKOFF_BASE = 0.05
+BACKOFF_CAP = 5.0
+
+# Number of segments scanned in parallel when loading samples
+SCAN_SEGMENTS = _positive_int("SCAN_SEGMENTS", 4)
+
+# Number of recent documents kept in memory for indirect matching
+DOCUMENT_WINDOW = _positive_int("DOCUMENT_WINDOW", 10000)
+
+# Number of processed document hashes kept for skipping redelivered documents
+DEDUP_WINDOW = _positive_int("DEDUP_WINDOW", 100000)
+
+def _backoff(attempt: int):
+    """Sleeps before a retry using exponential backoff with jitter"""
+    time.sleep(min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt) + random.uniform(0, BACKOFF_BASE))
+
+class _SqsBuffer:
+    """Sends messages from a background thread in batches of up to 10,
+    once a batch is full or its oldest message has waited SQS_BUFFER_SECONDS"""
+    _FLUSH = object()
+
+    def __init__(self, send_batch: Callable[[List[Dict]], None]):
+        self._send_batch = send_batch
+        self._queue: queue.Queue = queue.Queue()
+        self._errors: List[Tuple[List[Dict], Exception]] = []
+        self._errors_lock = threading.Lock()
+        self._thread = threading.Thread(target=self.run_forever, daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def put(self, message: Dict):
+        """Adds a message entry to the buffer"""
+        self._queue.put(message)
+
+    def flush(self):
+        """Sends any buffered messages and waits until they are sent,
+        raising if any batch since the last flush failed to send"""
+        self._queue.put(self._FLUSH)
+        self._queue.join()
+
+        with self._errors_lock:
+            errors, self._errors = self._errors, []
+        if errors:
+            failed = sum(len(messages) for messages, _ in errors)
+            raise RuntimeError(f"Failed to send {failed} buffered messages") from errors[0][1]
+
+    def run_forever(self):
+        """Collects messages into batches and sends them"""
+        batch: Deque[Dict] = deque()
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                message = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                message = None
+
+            if message is not None and message is not self._FLUSH:
+                if not batch:
+                    deadline = time.monotonic() + SQS_BUFFER_SECONDS
+                batch.append(message)
+                if len(batch) < SQS_BATCH_SIZE:
+                    continue
+
+            self._send(batch)
+            deadline = None
+            if message is self._FLUSH:
+                self._queue.task_done()
+
+    def _send(self, batch: Deque[Dict]):
+        if not batch:
+            return
+        messages = list(batch)
+        batch.clear()
+        try:
+            self._send_batch(messages)
+        except Exception as e:
+            # Reported to the caller on the next flush
+            logger.error(f"Error sending buffered messages: {e}", exc_info=True)
+            with self._errors_lock:
+                self._errors.append((messages, e))
+        finally:
+            for _ in messages:
+                self._queue.task_done()
 
 class DocumentMatcher:
     def __init__(self):
         self.samples: Dict[str, Dict] = {}
-        self.documents: List[Dict] = []
-        self.matches: Dict[str, List[Dict]] = defaultdict(list)
+        self.documents: Deque[Tuple[Dict, bytes, FrozenSet]] = deque()
+        self._write_buffer: List[Tuple[str, Dict]] = []
+        self._value_to_samples: Dict[Any, Set[str]] = defaultdict(set)
+        # Values of every document matched so far; not evicted, since a later document
+        # can match through any of them, but keyed by compact digests for nested values
+        self._match_value_index: Dict[Any, Set[str]] = defaultdict(set)
+        # Samples each document in the window has been stored for, dropped on eviction
+        self._match_seen: Dict[bytes, Set[str]] = {}
+        # The most recent DEDUP_WINDOW processed documents, oldest first
+        self._doc_hashes: OrderedDict[bytes, None] = OrderedDict()
+        self._batch_hashes: Dict[bytes, None] = {}
+        self._doc_value_index: Dict[Any, Deque[Tuple[Dict, bytes, FrozenSet]]] = defaultdict(deque)
+        self._samples_loaded = False
+        self._sqs_buffer: Optional[_SqsBuffer] = None
+        self._sqs_buffer_lock = threading.Lock()
+        self._shards: Dict[str, int] = {}
         
         # Initializing DynamoDB tables
         sample_table_name = os.getenv("SAMPLE_TABLE_NAME", "SampleTable")
         matched_table_name = os.getenv("MATCHED_TABLE_NAME", "MatchedDocuments")
         
-        self.sample_table = dynamodb.Table(sample_table_name)
-        self.matched_table = dynamodb.Table(matched_table_name)
-        
-        # Loading existing samples from DynamoDB
-        self.load_samples()
+        self.sample_table = _dynamodb().Table(sample_table_name)
+        self.matched_table = _dynamodb().Table(matched_table_name)
 
     def load_samples(self):
-        """Loading samples from DynamoDB table on initialization"""
+        """Loading samples from DynamoDB table before the first document is matched"""
         try:
             logger.info("Loading samples from DynamoDB table...")
-            response = self.sample_table.scan()
-            for item in response.get('Items', []):
-                self.samples[item['sample_id']] = item['description']
+            with ThreadPoolExecutor(max_workers=SCAN_SEGMENTS) as executor:
+                for items in executor.map(self._scan_segment, range(SCAN_SEGMENTS)):
+                    for item in items:
+                        self._set_sample(item['sample_id'], item['description'])
+            self._samples_loaded = True
             logger.info(f"Loaded {len(self.samples)} samples successfully.")
         except ClientError as e:
             logger.error(f"Error loading samples: {e}", exc_info=True)
             raise
     
+    def _scan_segment(self, segment: int) -> List[Dict]:
+        """Scans one segment of the sample table, following every page"""
+        # Clients are thread-safe whereas Table resources are not
+        paginator = self.sample_table.meta.client.get_paginator('scan')
+        pages = paginator.paginate(
+            TableName=self.sample_table.name,
+            TotalSegments=SCAN_SEGMENTS,
+            Segment=segment,
+            ProjectionExpression="sample_id, #description",
+            ExpressionAttributeNames={"#description": "description"},
+            ConsistentRead=False,
+        )
+        return [item for page in pages for item in page.get('Items', [])]
+    
     def add_sample(self, sample_id: str, sample_description: Dict):
         """Add a new sample description"""
-        self.samples[sample_id] = sample_description
+        # Nothing to write if the sample is already stored unchanged
+        if self.samples.get(sample_id) == sample_description:
+            return
+        self._set_sample(sample_id, sample_description)
         self.sample_table.put_item(Item={"sample_id": sample_id, "description": sample_description})
+
+    def add_samples(self, samples: Dict[str, Dict]):
+        """Add several sample descriptions using batched writes"""
+        changed = {
+            sample_id: sample_description for sample_id, sample_description in samples.items()
+            if self.samples.get(sample_id) != sample_description
+        }
+        if not changed:
+            return
+        for sample_id, sample_description in changed.items():
+            self._set_sample(sample_id, sample_description)
+        self._batch_put(self.sample_table, [
+            {"sample_id": sample_id, "description": sample_description}
+            for sample_id, sample_description in changed.items()
+        ])
+
+    def _batch_put(self, table, items: List[Dict]):
+        """Writes items with BatchWriteItem, retrying unprocessed items with backoff"""
+        client = table.meta.client
+        for start in range(0, len(items), BATCH_WRITE_SIZE):
+            request_items = {
+                table.name: [{"PutRequest": {"Item": item}} for item in items[start:start + BATCH_WRITE_SIZE]]
+            }
+            for attempt in range(MAX_WRITE_ATTEMPTS):
+                try:
+                    response = client.batch_write_item(RequestItems=request_items)
+                except ClientError as e:
+                    if e.response["Error"]["Code"] not in RETRYABLE_WRITE_ERRORS:
+                        logger.error(f"Error writing batch: {e}", exc_info=True)
+                        raise
+                else:
+                    request_items = response.get("UnprocessedItems")
+                    if not request_items:
+                        break
+                # No point waiting once there is no attempt left
+                if attempt + 1 < MAX_WRITE_ATTEMPTS:
+                    _backoff(attempt)
+            else:
+                raise RuntimeError(f"Failed to write items to {table.name} after {MAX_WRITE_ATTEMPTS} attempts")
+        
+    @staticmethod
+    def document_key(document: Dict) -> bytes:
+        """Returns a content hash identifying the document"""
+        encoded = _encode_canonical(document).encode()
+        return hashlib.blake2b(encoded, digest_size=16).digest()
+
+    def _set_sample(self, sample_id: str, sample_description: Dict):
+        """Stores the sample and indexes its values for direct matching"""
+        previous = self.samples.get(sample_id)
+        if previous is not None:
+            for value in previous.values():
+                self._value_to_samples[self._value_key(value)].discard(sample_id)
+
+        self.samples[sample_id] = sample_description
+        for value in sample_description.values():
+            self._value_to_samples[self._value_key(value)].add(sample_id)
+
+    @classmethod
+    def _value_key(cls, value: Any) -> Any:
+        """Returns a hashable form of a value, replacing lists, dicts and sets with a digest"""
+        try:
+            hash(value)
+            return value
+        except TypeError:
+            encoded = _encode_canonical(value).encode()
+            return hashlib.blake2b(encoded, digest_size=16).digest()
+
+    @classmethod
+    def _value_set(cls, values: Iterable) -> FrozenSet:
+        """Returns the hashable forms of the values as a set"""
+        return frozenset(cls._value_key(v) for v in values)
         
     def add_document(self, document: Dict):
         """Process a document and store the matches in DynamoDB"""
+        self.add_documents([document])
+
+    def _add_document(self, document: Dict):
+        """Matches a document, buffering its matches for add_documents to write"""
         logger.info(f"Processing document")
         try:
-            self.documents.append(document)
-            flattened_doc = self.flatten_doc(document)
+            if not self._samples_loaded:
+                self.load_samples()
+            
+            doc_key = self.document_key(document)
+            if doc_key in self._doc_hashes or doc_key in self._batch_hashes:
+                logger.info("Skipping duplicate document")
+                return
+            # Only counted as processed once the batch's matches are written
+            self._batch_hashes[doc_key] = None
+
+            # Rejected before it is remembered, since no matched list could ever hold it
+            if len(_encode(document)) > MAX_ITEM_BYTES:
+                raise ValueError(f"Document is larger than the {MAX_ITEM_BYTES} byte DynamoDB item limit")
+
+            doc_values = self._value_set(document.values())
+            self._remember((document, doc_key, doc_values))
             
             # Processing direct match
-            matched_sample_ids = self.direct_match(flattened_doc)
+            matched_sample_ids = self.direct_match(self._value_set(self.leaf_values(document)))
             if matched_sample_ids:
                 for sample_id in matched_sample_ids:
-                    self.store_match(sample_id, document)
+                    self.store_match(sample_id, document, doc_key, doc_values)
             
             # Processing indirect matches
-            self.indirect_match(flattened_doc)
+            self.indirect_match(document, doc_key, doc_values)
             logger.info(f"Proccessed document: {document}")
             
         except ClientError as e:
             logger.error(f"Error proccessing document: {e}", exc_info=True)
             raise
 
-    def direct_match(self, document: Dict):
+    def _remember(self, entry: Tuple[Dict, bytes, FrozenSet]):
+        """Adds the document to the recent window, evicting the oldest once it is full"""
+        # A redelivered document may still be in the window
+        if entry[1] in self._match_seen:
+            return
+        if len(self.documents) >= DOCUMENT_WINDOW:
+            evicted = self.documents.popleft()
+            del self._match_seen[evicted[1]]
+            # The oldest document is always first in each of its index entries
+            for value in evicted[2]:
+                entries = self._doc_value_index[value]
+                entries.popleft()
+                if not entries:
+                    del self._doc_value_index[value]
+
+        self.documents.append(entry)
+        self._match_seen[entry[1]] = set()
+        for value in entry[2]:
+            self._doc_value_index[value].append(entry)
+
+    def add_documents(self, documents: List[Dict]):
+        """Process a batch of documents and store all of their matches together"""
+        try:
+            try:
+                for document in documents:
+                    self._add_document(document)
+            finally:
+                # Matches found before a failing document are still written
+                self._flush()
+        except Exception:
+            # SQS redelivers a failed batch, so its documents must not be skipped as duplicates
+            self._batch_hashes.clear()
+            raise
+        self._doc_hashes.update(self._batch_hashes)
+        self._batch_hashes.clear()
+        while len(self._doc_hashes) > DEDUP_WINDOW:
+            self._doc_hashes.popitem(last=False)
+
+    def direct_match(self, doc_values: FrozenSet):
         """Finds direct matches with existing samples"""
-        return [
-            sample_id for sample_id, sample_desc in self.samples.items() 
-            if any(doc_value in sample_desc.values() for doc_value in document.values())
-            ]
+        matched_sample_ids = set()
+        for doc_value in doc_values:
+            matched_sample_ids |= self._value_to_samples.get(doc_value, set())
+        return list(matched_sample_ids)
             
-    def indirect_match(self, new_doc: Dict):
-        """Find indirect matches with other documents"""
-        for doc in self.documents:
-            for match_id, match_docs in self.matches.items():
-                if any(self.has_matching_fields(doc, match_doc)
-                       for match_doc in match_docs if doc != match_doc): 
-                    self.store_match(match_id, doc)
-    
-    def has_matching_fields(self, doc1: Dict, doc2: Dict):
-        """Check if the document contains any matching fields"""
-        return any(doc1[key1] == doc2[key2] for key1 in doc1 for key2 in doc2)
+    def indirect_match(self, document: Dict, doc_key: bytes, doc_values: FrozenSet):
+        """Find indirect matches through documents already matched to a sample"""
+        matched_sample_ids = set()
+        for value in doc_values:
+            matched_sample_ids |= self._match_value_index.get(value, set())
+        for match_id in matched_sample_ids:
+            self.store_match(match_id, document, doc_key, doc_values)
         
-    def store_match(self, sample_id: str, document: Dict):
-        """Stores the matched documents in DynamoDB"""
-        if document not in self.matches[sample_id]:
-            self.matches[sample_id].append(document)
+    def store_match(self, sample_id: str, document: Dict, doc_key: Optional[bytes] = None,
+                    doc_values: Optional[FrozenSet] = None):
+        """Records the match, and the documents it indirectly matches, for writing to DynamoDB"""
+        if doc_key is None:
+            doc_key = self.document_key(document)
+        if sample_id in self._match_seen.get(doc_key, ()):
+            return
+        if doc_values is None:
+            doc_values = self._value_set(document.values())
+
+        pending = [(document, doc_key, doc_values)]
+        while pending:
+            document, doc_key, doc_values = pending.pop()
+            # Only documents in the window are tracked, which keeps this bounded
+            seen = self._match_seen.get(doc_key, set())
+            if sample_id in seen:
+                continue
+            seen.add(sample_id)
+            self._write_buffer.append((sample_id, document))
+
+            # Earlier documents sharing a value with this one now match the sample too
+            for value in doc_values:
+                self._match_value_index[value].add(sample_id)
+                pending.extend(
+                    entry for entry in self._doc_value_index.get(value, ())
+                    if sample_id not in self._match_seen[entry[1]]
+                )
+
+        if len(self._write_buffer) >= MAX_BUFFERED_WRITES:
+            self._flush()
+
+    def _flush(self):
+        """Writes the buffered matches to DynamoDB with one request per sample"""
+        if not self._write_buffer:
+            return
+        pending: Dict[str, List[Dict]] = defaultdict(list)
+        for sample_id, document in self._write_buffer:
+            pending[sample_id].append(document)
+        self._write_buffer = []
+
+        try:
+            while pending:
+                sample_id, documents = next(iter(pending.items()))
+                for chunk in self._size_chunks(list(documents)):
+                    self._append_matches(sample_id, chunk)
+                    del documents[:len(chunk)]
+                del pending[sample_id]
+        finally:
+            # Matches that were not written stay buffered for the next flush
+            self._write_buffer = [
+                (sample_id, document) for sample_id, documents in pending.items() for document in documents
+            ]
+
+    def _append_matches(self, sample_id: str, documents: List[Dict]):
+        """Appends documents to the sample's matched list, which is sharded over the items
+        sample_id, sample_id#1, sample_id#2, ... as each one reaches DynamoDB's item size limit"""
+        shard = self._current_shard(sample_id)
+        for advance in range(MAX_SHARD_ADVANCES + 1):
+            if advance:
+                shard = self._advance_shard(sample_id, shard)
+            # Appends to the list of documents, creating it on the first match
+            request = {
+                "Key": {"sample_id": f"{sample_id}#{shard}" if shard else sample_id},
+                "UpdateExpression": "SET description = list_append(if_not_exists(description, :empty), :docs)",
+                "ExpressionAttributeValues": {":docs": documents, ":empty": []},
+            }
+            if not shard:
+                # The shard number lives on the base item from its first write, so that
+                # advancing it later never grows a full item
+                request["UpdateExpression"] += ", #shard = if_not_exists(#shard, :zero)"
+                request["ExpressionAttributeNames"] = {"#shard": "shard"}
+                request["ExpressionAttributeValues"][":zero"] = 0
             try:
-                # Update the existing list of documents
-                self.matched_table.update_item(
-                    Key={"sample_id": sample_id},
-                    UpdateExpression="SET description = list_append(description, :doc)",
-                    ExpressionAttributeValues={":doc": [document]},
-                    ConditionExpression="attribute_exists(description)",
-                )      
-                logger.info(f"Match updated: {document}")
-                          
+                self.matched_table.update_item(**request)
+                logger.info(f"Matches stored for {request['Key']['sample_id']}: {len(documents)}")
+                return
+
             except ClientError as e:
-                if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
-                    try:
-                        self.matched_table.put_item(Item={"sample_id": sample_id, "description": [document]})
-                        logger.info(f"Match inserted: {document}")
-                        
-                    except ClientError as e:
-                        logger.error(f"Error inserting new match: {e}", exc_info=True)
-                        raise
-                else:
-                    logger.error(f"Error updating matches: {e}", exc_info=True)
+                # A full shard rejects the update, so the documents go to a newer one
+                error = e.response["Error"]
+                if error["Code"] != "ValidationException" or "maximum allowed size" not in error.get("Message", ""):
+                    logger.error(f"Error storing matches: {e}", exc_info=True)
                     raise
-    
-    def enqueue_document(self, document: Dict):
+
+        raise RuntimeError(f"Failed to store matches for {sample_id} after {MAX_SHARD_ADVANCES} new shards")
+
+    def _current_shard(self, sample_id: str) -> int:
+        """Returns the newest shard of the sample's matched list, read from its base item on a cache miss"""
+        if sample_id not in self._shards:
+            item = self.matched_table.get_item(
+                Key={"sample_id": sample_id},
+                ProjectionExpression="#shard",
+                ExpressionAttributeNames={"#shard": "shard"},
+                ConsistentRead=True,
+            ).get("Item", {})
+            self._shards[sample_id] = int(item.get("shard", 0))
+        return self._shards[sample_id]
+
+    def _advance_shard(self, sample_id: str, shard: int) -> int:
+        """Records the shard after the given one as the newest, unless another container already has"""
         try:
-            queue_url = os.getenv("QUEUE_URL")
-            if not queue_url:
-                raise ValueError("QUEUE_URL environment variable is not set")
-            
-            sqs.send_message(QueueUrl=queue_url, MessageBody=json.dumps(document))
+            self.matched_table.update_item(
+                Key={"sample_id": sample_id},
+                UpdateExpression="SET #shard = :next",
+                ConditionExpression="attribute_not_exists(#shard) OR #shard < :next",
+                ExpressionAttributeNames={"#shard": "shard"},
+                ExpressionAttributeValues={":next": shard + 1},
+            )
+            self._shards[sample_id] = shard + 1
         except ClientError as e:
-            print(f"Error enqueuing document: {e}")
-            raise
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                logger.error(f"Error advancing shard: {e}", exc_info=True)
+                raise
+            # Another container moved past this shard, so its newest shard is read again
+            del self._shards[sample_id]
+        return self._current_shard(sample_id)
+
+    @staticmethod
+    def _size_chunks(documents: List[Dict]) -> Iterable[List[Dict]]:
+        """Splits documents into chunks that each fit in an empty item"""
+        chunk, size = [], 0
+        for document in documents:
+            doc_size = len(_encode(document))
+            if chunk and size + doc_size > MAX_APPEND_BYTES:
+                yield chunk
+                chunk, size = [], 0
+            chunk.append(document)
+            size += doc_size
+        if chunk:
+            yield chunk
     
-    def flatten_doc(self, doc: Dict, parent_key: str = '', sep: str = '.') -> Dict:
-        """Flatten nested document dictionary structure"""
-        flattened = {}
-        for k, v in doc.items():
-            new_key = f"{parent_key}{sep}{k}" if parent_key else k
-            if isinstance(v, dict):
-                flattened.update(self.flatten_doc(v, new_key, sep))
-            else:
-                flattened[new_key] = v
-        return flattened
+    def enqueue_document(self, document: Dict):
+        """Buffers the document to be sent to SQS with other documents in one batch"""
+        if not QUEUE_URL:
+            raise ValueError("QUEUE_URL environment variable is not set")
+
+        if self._sqs_buffer is None:
+            with self._sqs_buffer_lock:
+                if self._sqs_buffer is None:
+                    self._sqs_buffer = _SqsBuffer(self._send_messages)
+        self._sqs_buffer.put(self._message_entry(document))
+
+    def _send_messages(self, messages: List[Dict]):
+        """Sends message entries in as few SQS batches as the batch limits allow"""
+        for batch in self._message_batches(messages):
+            entries = [{"Id": str(i), **message} for i, message in enumerate(batch)]
+            self._send_batch(QUEUE_URL, entries)
+
+    @staticmethod
+    def _message_batches(messages: List[Dict]) -> Iterable[List[Dict]]:
+        """Splits message entries into batches within both the count and payload limits"""
+        batch, size = [], 0
+        for message in messages:
+            message_size = len(message["MessageBody"].encode())
+            if batch and (len(batch) == SQS_BATCH_SIZE or size + message_size > SQS_BATCH_BYTES):
+                yield batch
+                batch, size = [], 0
+            batch.append(message)
+            size += message_size
+        if batch:
+            yield batch
+
+    def _message_entry(self, document: Dict) -> Dict:
+        """Builds the SQS message for a document, deduplicated by content on FIFO queues"""
+        entry = {"MessageBody": _encode(document)}
+        if QUEUE_URL.endswith(".fifo"):
+            entry["MessageDeduplicationId"] = self.document_key(document).hex()
+            entry["MessageGroupId"] = MESSAGE_GROUP_ID
+        return entry
+
+    def enqueue_documents(self, documents: List[Dict]):
+        """Enqueue documents to SQS in batches of up to 10 messages and 256KB"""
+        if not QUEUE_URL:
+            raise ValueError("QUEUE_URL environment variable is not set")
+
+        self._send_messages([self._message_entry(doc) for doc in documents])
+
+    def _send_batch(self, queue_url: str, entries: List[Dict]):
+        """Sends a message batch, retrying failed entries with exponential backoff"""
+        for attempt in range(MAX_SEND_ATTEMPTS):
+            try:
+                response = _sqs().send_message_batch(QueueUrl=queue_url, Entries=entries)
+            except ClientError as e:
+                print(f"Error enqueuing documents: {e}")
+                raise
+
+            failed = response.get("Failed", [])
+            if not failed:
+                return
+
+            # Sender faults are not transient, so retrying them is pointless
+            sender_faults = [f for f in failed if f.get("SenderFault")]
+            if sender_faults:
+                raise ValueError(f"Error enqueuing documents: {sender_faults}")
+
+            failed_ids = {f["Id"] for f in failed}
+            entries = [entry for entry in entries if entry["Id"] in failed_ids]
+            if attempt + 1 < MAX_SEND_ATTEMPTS:
+                _backoff(attempt)
+
+        raise RuntimeError(f"Failed to enqueue {len(entries)} documents after {MAX_SEND_ATTEMPTS} attempts")
+    
+    @staticmethod
+    def leaf_values(doc: Dict) -> List:
+        """Collects the leaf values of a nested document"""
+        values = []
+        stack = [doc]
+        while stack:
+            for v in stack.pop().values():
+                if isinstance(v, dict):
+                    stack.append(v)
+                else:
+                    values.append(v)
+        return values
+
+# DocumentMatcher is created once per container and reused across invocations
+@lru_cache(maxsize=None)
+def _matcher() -> DocumentMatcher:
+    return DocumentMatcher()
 
-# Initialize DocumentMatcher outside handler for Lambda reuse
-matcher = DocumentMatcher()
+# Samples are loaded on the first document unless preloading is requested,
+# in which case they are loaded during the Lambda init phase
+if os.getenv("PRELOAD_SAMPLES"):
+    _matcher().load_samples()
 
 def lambda_handler(event, context):
     """Process SQS messages and match documents"""
     try:
-        for record in event['Records']:
-            document = json.loads(record['body'])
-            matcher.add_document(document)
+        documents = [json.loads(record['body']) for record in event['Records']]
+        _matcher().add_documents(documents)
             
-        return {'statusCode': 200, 'body': document}
+        return {'statusCode': 200, 'body': documents[-1]}
     
     except Exception as e:
-        print(f"Error processing batch: {e}")
-        return {'statusCode': 500, 'body': f'Error processing documents: {str(e)}'}
+        # Returning normally would delete the batch from the queue, so the error is
+        # raised for SQS to redeliver the batch once its visibility timeout expires
+        logger.error(f"Error processing batch: {e}", exc_info=True)
+        raise
     
\ No newline at end of file
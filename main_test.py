@@ -1,5 +1,6 @@
 from typing import List, Dict, Optional
 import json
+import hashlib
 import boto3
 from botocore.exceptions import ClientError
 from collections import defaultdict
@@ -15,6 +16,10 @@ class DocumentMatcher:
         self.samples: Dict[str, Dict] = {}
         self.documents: list[Dict] = []
         self.matches: Dict[str, List[Dict]] = {}
+        self.match_keys: Dict[str, set] = defaultdict(set) # Content hashes of the matched documents
+        self.value_sets: Dict[int, frozenset] = {} # Field values of each stored document, keyed by id()
+        self.sample_value_sets: Dict[str, frozenset] = {} # Field values of each sample
+        self.pending_matches: Dict[str, List[Dict]] = defaultdict(list) # Matches not yet written to the table
         
         dynamodb = boto3.resource('dynamodb', region_name=os.getenv('AWS_DEFAULT_REGION'))
         self.sqs = boto3.client('sqs', region_name=os.getenv('AWS_DEFAULT_REGION'))
@@ -25,12 +30,26 @@ class DocumentMatcher:
         self.matched_table = dynamodb.Table("test_MatchedDocuments")
 
     def add_sample(self, sample_id: str, sample_description: Dict):
+        if self.samples.get(sample_id) == sample_description: # Unchanged samples are not written again
+            return
         self.samples[sample_id] = sample_description
+        self.sample_value_sets[sample_id] = self.value_set(sample_description)
         self.sample_table.put_item(Item={"sample_id": sample_id, "description": sample_description})
+
+    def add_samples(self, samples: Dict[str, Dict]):
+        changed = {sample_id: desc for sample_id, desc in samples.items() if self.samples.get(sample_id) != desc}
+        self.samples.update(changed)
+        for sample_id, sample_description in changed.items():
+            self.sample_value_sets[sample_id] = self.value_set(sample_description)
+        with self.sample_table.batch_writer() as batch:
+            for sample_id, sample_description in changed.items():
+                batch.put_item(Item={"sample_id": sample_id, "description": sample_description})
     
     def add_document(self, document: Dict):
         """This function takes a document, matches it, and adds it to a table."""
         self.documents.append(document)
+        self.value_sets[id(document)] = self.value_set(document)
+        doc_key = self.document_key(document)
         flattened_doc = self.flatten_doc(document)
         
         matched_sample_ids = self.direct_match(flattened_doc)
@@ -42,12 +61,29 @@ class DocumentMatcher:
                     self.matches[sample_id] = []
                 
                 # Same document will not be added to matches
-                if document not in self.matches[sample_id]:
+                if doc_key not in self.match_keys[sample_id]:
+                    self.match_keys[sample_id].add(doc_key)
                     self.matches[sample_id].append(document)
-                    self.matched_table.put_item(Item={"sample_id": sample_id, "description": document})
+                    self.pending_matches[sample_id].append(document)
                 
         self.indirect_match(flattened_doc)
         
+    def document_key(self, document: Dict) -> bytes:
+        """Hashes the document content so membership checks don't compare whole documents."""
+        encoded = json.dumps(document, sort_keys=True, separators=(',', ':')).encode()
+        return hashlib.blake2b(encoded, digest_size=16).digest()
+        
+    def value_set(self, document: Dict) -> frozenset:
+        """Collects the document's field values into a set so documents can be compared by hashing.
+        Nested dictionaries and lists are converted to hashable equivalents."""
+        def hashable(value):
+            if isinstance(value, dict):
+                return frozenset((key, hashable(item)) for key, item in value.items())
+            if isinstance(value, list):
+                return tuple(hashable(item) for item in value)
+            return value
+        return frozenset(hashable(value) for value in document.values())
+        
     def count_matching_values(self,document):
         '''Writing this function in interview'''
         matched_samples={}
@@ -67,28 +103,47 @@ class DocumentMatcher:
     def direct_match(self, document: Dict):
         """The function loops through each sample and compares the document with every sample, 
         returning a list of keys that identify the samples the document matched."""
+        doc_values = self.value_set(document)
         matched_samples = [] # List of keys for all matched samples
-        for sample_id, sample_desc in self.samples.items():
+        for sample_id, sample_values in self.sample_value_sets.items():
             
             # Matching documents by their field values
-            if any(doc_value in sample_desc.values() for doc_value in document.values()):
+            if not sample_values.isdisjoint(doc_values):
                 matched_samples.append(sample_id)
         return matched_samples if matched_samples else None
     
     def indirect_match(self, new_doc: Dict):
         """ The function loops through all documents and compares each document with every document in the 
-        matches dictionary. The document which indirectly matches to another document is added to the list."""
-        for doc in self.documents:
-            for match_id, match_docs in self.matches.items():
-                for match_doc in match_docs:
-                    if doc == match_doc: # Same document is not added
-                        continue
-                    
-                    # Matching a document with any of its attributes
-                    if any(doc[key1] == match_doc[key2] for key1 in doc for key2 in match_doc):
-                        if doc not in self.matches[match_id]:   # Document should not be added if it already exists
-                            self.matches[match_id].append(doc)
-                            self.matched_table.put_item(Item={"sample_id": match_id, "description": doc})
+        matches dictionary. The document which indirectly matches to another document is added to the list.
+        Passes repeat until one adds nothing, so a document linked through a later match is found as well."""
+        added = True
+        while added:
+            added = False
+            for doc in self.documents:
+                doc_key = self.document_key(doc)
+                doc_values = self.value_sets[id(doc)]
+                for match_id, match_docs in self.matches.items():
+                    for match_doc in match_docs:
+                        if doc == match_doc: # Same document is not added
+                            continue
+                        
+                        # Matching a document with any of its attributes
+                        if not doc_values.isdisjoint(self.value_sets[id(match_doc)]):
+                            if doc_key not in self.match_keys[match_id]:   # Document should not be added if it already exists
+                                self.match_keys[match_id].add(doc_key)
+                                self.matches[match_id].append(doc)
+                                self.pending_matches[match_id].append(doc)
+                                added = True
+    
+    def flush_matches(self):
+        """Appends the pending matches to the table, with one write per sample instead of one per document."""
+        for sample_id, documents in self.pending_matches.items():
+            self.matched_table.update_item(
+                Key={"sample_id": sample_id},
+                UpdateExpression="SET description = list_append(if_not_exists(description, :empty), :docs)",
+                ExpressionAttributeValues={":docs": documents, ":empty": []}
+            )
+        self.pending_matches.clear()
     
     def enqueue_document(self, document: Dict):
         self.sqs.send_message(QueueUrl=self.queue_url, MessageBody=json.dumps(document))
@@ -96,6 +151,20 @@ class DocumentMatcher:
         event = {"Records": [{"body": json.dumps(document)}]}
         context = {}
         self.lambda_handler(event, context)
+
+    def enqueue_documents(self, documents: List[Dict]):
+        """Sends documents to the queue in batches of 10, the SQS batch limit,
+        and processes each batch the way an SQS trigger would deliver it."""
+        for start in range(0, len(documents), 10):
+            chunk = documents[start:start + 10]
+            self.sqs.send_message_batch(
+                QueueUrl=self.queue_url,
+                Entries=[{"Id": str(i), "MessageBody": json.dumps(doc)} for i, doc in enumerate(chunk)]
+            )
+
+            event = {"Records": [{"body": json.dumps(doc)} for doc in chunk]}
+            context = {}
+            self.lambda_handler(event, context)
         
     def get_samples(self):
         return self.samples
@@ -106,30 +175,40 @@ class DocumentMatcher:
     def flatten_doc(self, doc, parent_key='', sep='.'):
         """ 
         The function flattens a nested dictionary for easy traversal and comparison.
+        Nested dictionaries are walked with a stack instead of recursive calls.
         """
+        if not any(isinstance(value, dict) for value in doc.values()):
+            return doc
+        
         flattened_doc={}
-        for key, value in doc.items():
-            new_key = f"{parent_key}{sep}{key}" if parent_key else key
-            if isinstance(value, dict):
-                flattened_doc.update(self.flatten_doc(value, key, sep))
-            else:
-                flattened_doc[new_key] = value
+        stack = [(parent_key, doc)]
+        while stack:
+            prefix, current = stack.pop()
+            for key, value in current.items():
+                new_key = f"{prefix}{sep}{key}" if prefix else key
+                if isinstance(value, dict):
+                    stack.append((new_key, value))
+                else:
+                    flattened_doc[new_key] = value
         return flattened_doc
 
     def lambda_handler(self, event, context):
-        for record in event['Records']:
-            document = json.loads(record['body'])
-            try:
+        try:
+            for record in event['Records']:
+                document = json.loads(record['body'])
                 self.add_document(document)
+            
+            # Matches from the whole batch are written together
+            self.flush_matches()
                 
-            except Exception as e:
-                return {
-                    'statusCode': 500,
-                    'body': json.dumps({
-                        'message': 'Error processing document',
-                        'error': str(e)
-                    })
-                }
+        except Exception as e:
+            return {
+                'statusCode': 500,
+                'body': json.dumps({
+                    'message': 'Error processing document',
+                    'error': str(e)
+                })
+            }
         return { "statusCode": 200,
                 'body': json.dumps({
                     'message': 'Documents processed successfully'
@@ -170,16 +249,14 @@ def main():
     with open("samples.json", "r") as file:
         samples_file = json.load(file)
         
-    for sample_id, sample_desc in samples_file.items():
-        matcher.add_sample(sample_id, sample_desc)
+    matcher.add_samples(samples_file)
     
     print(json.dumps(matcher.get_samples(), indent=2))
         
     with open("documents.json", "r") as file:
         document_file = json.load(file)
         
-    for doc in document_file.values():
-        matcher.enqueue_document(doc)
+    matcher.enqueue_documents(list(document_file.values()))
 
     print(json.dumps(matcher.get_matches(), indent=2))
     
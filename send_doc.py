@@ -10,12 +10,28 @@ queue_url = os.getenv("QUEUE_URL")
 
 with open("documents.json", "r") as file:
     document_file = json.load(file)
-    
-for idx, doc in enumerate(document_file.values()):
-    response = sqs.send_message(
+
+documents = list(document_file.values())
+
+# SQS accepts at most 10 messages, and 256KB of message bodies, per batch
+batches, batch, size = [], [], 0
+for doc in documents:
+    body = json.dumps(doc)
+    body_size = len(body.encode())
+    if batch and (len(batch) == 10 or size + body_size > 256 * 1024):
+        batches.append(batch)
+        batch, size = [], 0
+    batch.append(body)
+    size += body_size
+if batch:
+    batches.append(batch)
+
+for batch in batches:
+    response = sqs.send_message_batch(
         QueueUrl=queue_url,
-        MessageBody=json.dumps(doc)
+        Entries=[{"Id": str(idx), "MessageBody": body} for idx, body in enumerate(batch)]
     )
     
     print("Response status code:", response['ResponseMetadata']['HTTPStatusCode'])
-
+    for failed in response.get('Failed', []):
+        print("Failed to send message:", failed)
@@ -0,0 +1,389 @@
+import json
+import os
+import unittest
+from unittest import mock
+
+# Environment must be set before main.py reads it at import
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+os.environ.setdefault("QUEUE_URL", "https://sqs.us-east-1.amazonaws.com/123456789012/TestQueue")
+
+import boto3
+from botocore.exceptions import ClientError
+from moto import mock_aws
+
+import main
+
+
+def sqs_event(documents):
+    return {"Records": [{"body": json.dumps(doc)} for doc in documents]}
+
+
+class MatcherTestCase(unittest.TestCase):
+    """Runs each test against fresh moto-backed tables and a fresh matcher."""
+
+    def setUp(self):
+        self.aws = mock_aws()
+        self.aws.start()
+        self.addCleanup(self.aws.stop)
+
+        main._dynamodb.cache_clear()
+        main._sqs.cache_clear()
+        main._matcher.cache_clear()
+
+        dynamodb = boto3.resource("dynamodb", region_name=os.environ["AWS_DEFAULT_REGION"])
+        for table_name in ("SampleTable", "MatchedDocuments"):
+            dynamodb.create_table(
+                TableName=table_name,
+                KeySchema=[{"AttributeName": "sample_id", "KeyType": "HASH"}],
+                AttributeDefinitions=[{"AttributeName": "sample_id", "AttributeType": "S"}],
+                BillingMode="PAY_PER_REQUEST",
+            )
+        self.matched_table = dynamodb.Table("MatchedDocuments")
+
+        # Retries should not slow the tests down
+        backoff = mock.patch.object(main, "_backoff")
+        self.backoff = backoff.start()
+        self.addCleanup(backoff.stop)
+
+    def add_samples(self, samples):
+        matcher = main._matcher()
+        matcher.add_samples(samples)
+        return matcher
+
+    def scan_matched(self):
+        """Yields every matched item, following scan pages past the 1MB limit"""
+        kwargs = {}
+        while True:
+            page = self.matched_table.scan(**kwargs)
+            yield from page["Items"]
+            if "LastEvaluatedKey" not in page:
+                return
+            kwargs["ExclusiveStartKey"] = page["LastEvaluatedKey"]
+
+    def stored_matches(self):
+        """Returns the stored documents of each sample, joining the shards of its matched list"""
+        shards = {}
+        for item in self.scan_matched():
+            sample_id, _, shard = item["sample_id"].partition("#")
+            shards.setdefault(sample_id, []).append((int(shard or 0), item["description"]))
+        return {
+            sample_id: [doc for _, docs in sorted(sample_shards, key=lambda shard: shard[0]) for doc in docs]
+            for sample_id, sample_shards in shards.items()
+        }
+
+
+class MatchingTest(MatcherTestCase):
+    def test_sample_files_match_expected_counts(self):
+        with open("samples.json") as file:
+            self.add_samples(json.load(file))
+        with open("documents.json") as file:
+            documents = list(json.load(file).values())
+
+        for start in range(0, len(documents), 10):
+            response = main.lambda_handler(sqs_event(documents[start:start + 10]), None)
+            self.assertEqual(response["statusCode"], 200)
+
+        # Samples 2 and 3 reach two of their documents only through the last document, which
+        # a single pass per arriving document missed; main_test.py agrees on these counts
+        counts = {sample_id: len(docs) for sample_id, docs in self.stored_matches().items()}
+        self.assertEqual(counts, {
+            "Sample 1": 4, "Sample 2": 8, "Sample 3": 8,
+            "Sample 4": 7, "Sample 5": 6, "Sample 6": 6,
+        })
+
+    def test_indirect_matches_chain_across_batches(self):
+        self.add_samples({"S1": {"Customer Name": "Acme"}})
+        first = {"invoice": "A-1", "ref": "R-1"}
+        second = {"ref": "R-1", "order": "O-7"}
+        unrelated = {"invoice": "Z-9"}
+        main.lambda_handler(sqs_event([first, second, unrelated]), None)
+        self.assertEqual(self.stored_matches(), {})
+
+        # Matches the sample directly through a nested value, and links back to both earlier documents
+        third = {"order": "O-7", "customer": {"name": "Acme"}}
+        main.lambda_handler(sqs_event([third]), None)
+
+        stored = self.stored_matches()["S1"]
+        self.assertCountEqual(stored, [first, second, third])
+
+    def test_duplicate_documents_are_skipped(self):
+        self.add_samples({"S1": {"Customer Name": "Acme"}})
+        document = {"name": "Acme", "invoice": "A-1"}
+        main.lambda_handler(sqs_event([document, document]), None)
+        main.lambda_handler(sqs_event([document]), None)
+
+        self.assertEqual(self.stored_matches()["S1"], [document])
+
+
+class FlushTest(MatcherTestCase):
+    def test_failed_flush_keeps_unwritten_matches(self):
+        matcher = self.add_samples({"S1": {"Customer Name": "Acme"}, "S2": {"Customer Name": "Bolt"}})
+        update_item = matcher.matched_table.update_item
+        error = ClientError({"Error": {"Code": "InternalServerError", "Message": "boom"}}, "UpdateItem")
+        calls = []
+
+        def fail_second(**kwargs):
+            calls.append(kwargs["Key"]["sample_id"])
+            if len(calls) == 2:
+                raise error
+            return update_item(**kwargs)
+
+        with mock.patch.object(matcher.matched_table, "update_item", side_effect=fail_second):
+            with self.assertRaises(ClientError):
+                matcher.add_documents([{"name": "Acme"}, {"name": "Bolt"}])
+
+        self.assertEqual([sample_id for sample_id, _ in matcher._write_buffer], [calls[1]])
+
+        matcher._flush()
+        self.assertEqual(matcher._write_buffer, [])
+        self.assertEqual(self.stored_matches(), {"S1": [{"name": "Acme"}], "S2": [{"name": "Bolt"}]})
+
+    def test_matches_before_a_failing_document_are_flushed(self):
+        matcher = self.add_samples({"S1": {"Customer Name": "Acme"}})
+        with mock.patch.object(matcher, "indirect_match", side_effect=[None, ValueError("bad document")]):
+            with self.assertRaises(ValueError):
+                matcher.add_documents([{"name": "Acme"}, {"other": "x"}])
+
+        self.assertEqual(self.stored_matches(), {"S1": [{"name": "Acme"}]})
+
+    def test_add_document_writes_its_matches(self):
+        matcher = self.add_samples({"S1": {"Customer Name": "Acme"}})
+        matcher.add_document({"name": "Acme"})
+
+        self.assertEqual(self.stored_matches(), {"S1": [{"name": "Acme"}]})
+        self.assertEqual(matcher._batch_hashes, {})
+        self.assertEqual(list(matcher._doc_hashes), [matcher.document_key({"name": "Acme"})])
+
+    def test_failed_batch_is_processed_again_when_redelivered(self):
+        matcher = self.add_samples({"S1": {"Customer Name": "Acme"}})
+        batch = [{"name": "Acme", "ref": "R-1"}, {"ref": "R-1", "n": 2}]
+        error = ClientError({"Error": {"Code": "InternalServerError", "Message": "boom"}}, "UpdateItem")
+        # A failed batch raises so that SQS redelivers it
+        with mock.patch.object(matcher.matched_table, "update_item", side_effect=error):
+            with self.assertRaises(ClientError):
+                main.lambda_handler(sqs_event(batch), None)
+        with mock.patch.object(matcher, "indirect_match", side_effect=ValueError("bad document")):
+            with self.assertRaises(ValueError):
+                main.lambda_handler(sqs_event(batch), None)
+
+        self.assertEqual(main.lambda_handler(sqs_event(batch), None)["statusCode"], 200)
+        self.assertCountEqual(self.stored_matches()["S1"], batch)
+
+        # Once written, the batch's documents are skipped
+        main.lambda_handler(sqs_event(batch), None)
+        self.assertCountEqual(self.stored_matches()["S1"], batch)
+
+
+class ShardTest(MatcherTestCase):
+    def large_documents(self, start, count):
+        return [{"name": "Acme", "n": n, "payload": "x" * 50 * 1024} for n in range(start, start + count)]
+
+    def test_matched_list_is_sharded_past_the_item_size_limit(self):
+        self.add_samples({"S1": {"Customer Name": "Acme"}})
+        main.lambda_handler(sqs_event(self.large_documents(0, 10)), None)
+
+        # A cold container continues from the newest shard, even when an earlier one has room
+        main._matcher.cache_clear()
+        main.lambda_handler(sqs_event([{"name": "Acme", "n": 10}]), None)
+        for document in self.large_documents(11, 9):
+            main.lambda_handler(sqs_event([document]), None)
+
+        stored = self.stored_matches()["S1"]
+        self.assertEqual([int(doc["n"]) for doc in stored], list(range(20)))
+        shards = len(list(self.scan_matched()))
+        self.assertGreater(shards, 2)
+        base = self.matched_table.get_item(Key={"sample_id": "S1"})["Item"]
+        self.assertEqual(base["shard"], shards - 1)
+
+    def test_document_too_large_for_an_append_chunk_is_stored(self):
+        matcher = self.add_samples({"S1": {"Customer Name": "Acme"}})
+        documents = [{"name": "Acme", "payload": "x" * 200 * 1024}, {"name": "Acme", "payload": "y" * 380 * 1024}]
+        matcher.add_documents(documents)
+
+        self.assertEqual(self.stored_matches(), {"S1": documents})
+
+    def test_document_too_large_for_an_item_fails_the_batch(self):
+        self.add_samples({"S1": {"Customer Name": "Acme"}})
+        with self.assertRaises(ValueError):
+            main.lambda_handler(sqs_event([{"name": "Acme", "n": 1}, {"name": "Acme", "payload": "x" * 450 * 1024}]), None)
+
+        self.assertEqual(self.stored_matches(), {"S1": [{"name": "Acme", "n": 1}]})
+        self.assertEqual(len(main._matcher().documents), 1)
+
+    def test_shard_advances_are_capped(self):
+        matcher = self.add_samples({"S1": {"Customer Name": "Acme"}})
+        update_item = matcher.matched_table.update_item
+        error = ClientError({"Error": {
+            "Code": "ValidationException", "Message": "Item size to update has exceeded the maximum allowed size",
+        }}, "UpdateItem")
+        appends = []
+
+        def always_full(**kwargs):
+            if "description" in kwargs["UpdateExpression"]:
+                appends.append(kwargs["Key"]["sample_id"])
+                raise error
+            return update_item(**kwargs)
+
+        with mock.patch.object(matcher.matched_table, "update_item", side_effect=always_full):
+            with self.assertRaises(RuntimeError):
+                matcher.add_documents([{"name": "Acme"}])
+
+        self.assertEqual(appends, ["S1", "S1#1", "S1#2", "S1#3"])
+        self.assertEqual(matcher._write_buffer, [("S1", {"name": "Acme"})])
+
+
+class EvictionTest(MatcherTestCase):
+    def test_eviction_removes_index_entries(self):
+        matcher = self.add_samples({"S1": {"Customer Name": "Acme"}})
+        with mock.patch.object(main, "DOCUMENT_WINDOW", 2):
+            matcher.add_documents([{"only": "first"}, {"shared": "v"}, {"shared": "v", "n": 1}])
+
+            self.assertEqual(len(matcher.documents), 2)
+            self.assertNotIn("first", matcher._doc_value_index)
+            self.assertEqual(len(matcher._doc_value_index["v"]), 2)
+
+            matcher.add_documents([{"n": 2}])
+            self.assertEqual(len(matcher._doc_value_index["v"]), 1)
+
+    def test_match_tracking_and_hashes_are_bounded(self):
+        matcher = self.add_samples({"S1": {"Customer Name": "Acme"}})
+        documents = [{"name": "Acme", "n": n} for n in range(5)]
+        with mock.patch.object(main, "DOCUMENT_WINDOW", 2), mock.patch.object(main, "DEDUP_WINDOW", 3):
+            matcher.add_documents(documents)
+
+        window_keys = [entry[1] for entry in matcher.documents]
+        self.assertEqual(list(matcher._match_seen), window_keys)
+        self.assertEqual(list(matcher._doc_hashes), [matcher.document_key(doc) for doc in documents[2:]])
+
+    def test_nested_values_are_indexed_by_digest(self):
+        matcher = self.add_samples({"S1": {"Customer Name": "Acme"}})
+        matcher.add_documents([{"name": "Acme", "address": {"city": "Tampa", "zip": ["33601"]}}])
+
+        nested = [key for key in matcher._match_value_index if key != "Acme"]
+        self.assertEqual([len(key) for key in nested], [16])
+        self.assertEqual(matcher._value_key({"zip": ["33601"], "city": "Tampa"}), nested[0])
+
+
+class SettingsTest(unittest.TestCase):
+    def test_settings_below_one_are_rejected(self):
+        for value in ("0", "-2"):
+            with mock.patch.dict(os.environ, {"SCAN_SEGMENTS": value}):
+                with self.assertRaises(ValueError):
+                    main._positive_int("SCAN_SEGMENTS", 4)
+        with mock.patch.dict(os.environ, {"SCAN_SEGMENTS": "8"}):
+            self.assertEqual(main._positive_int("SCAN_SEGMENTS", 4), 8)
+
+    def test_document_window_below_one_is_rejected(self):
+        with mock.patch.dict(os.environ, {"DOCUMENT_WINDOW": "0"}):
+            with self.assertRaises(ValueError):
+                main._positive_int("DOCUMENT_WINDOW", 10000)
+
+
+class RetryTest(MatcherTestCase):
+    def test_batch_put_retries_unprocessed_items(self):
+        matcher = main._matcher()
+        client = matcher.sample_table.meta.client
+        batch_write_item = client.batch_write_item
+        calls = []
+
+        def throttle_first(RequestItems):
+            calls.append(RequestItems)
+            if len(calls) == 1:
+                return {"UnprocessedItems": RequestItems}
+            return batch_write_item(RequestItems=RequestItems)
+
+        with mock.patch.object(client, "batch_write_item", side_effect=throttle_first):
+            matcher.add_samples({"S1": {"Customer Name": "Acme"}})
+
+        self.assertEqual(len(calls), 2)
+        self.backoff.assert_called_once()
+        self.assertEqual(matcher.sample_table.get_item(Key={"sample_id": "S1"})["Item"]["description"],
+                         {"Customer Name": "Acme"})
+
+    def test_batch_put_gives_up_after_max_attempts(self):
+        matcher = main._matcher()
+        client = matcher.sample_table.meta.client
+        with mock.patch.object(client, "batch_write_item",
+                               side_effect=lambda RequestItems: {"UnprocessedItems": RequestItems}):
+            with self.assertRaises(RuntimeError):
+                matcher.add_samples({"S1": {"Customer Name": "Acme"}})
+
+        # No backoff after the final attempt
+        self.assertEqual(self.backoff.call_count, main.MAX_WRITE_ATTEMPTS - 1)
+
+    def test_batch_put_retries_throttling_errors(self):
+        matcher = main._matcher()
+        client = matcher.sample_table.meta.client
+        batch_write_item = client.batch_write_item
+        errors = [
+            ClientError({"Error": {"Code": code, "Message": "slow down"}}, "BatchWriteItem")
+            for code in ("ThrottlingException", "RequestLimitExceeded")
+        ]
+
+        def throttle(RequestItems):
+            if errors:
+                raise errors.pop(0)
+            return batch_write_item(RequestItems=RequestItems)
+
+        with mock.patch.object(client, "batch_write_item", side_effect=throttle):
+            matcher.add_samples({"S1": {"Customer Name": "Acme"}})
+
+        self.assertEqual(self.backoff.call_count, 2)
+        self.assertIn("Item", matcher.sample_table.get_item(Key={"sample_id": "S1"}))
+
+    def test_send_batch_retries_failed_entries(self):
+        sqs = mock.Mock()
+        sqs.send_message_batch.side_effect = [
+            {"Failed": [{"Id": "1", "SenderFault": False}]},
+            {"Successful": [{"Id": "1"}]},
+        ]
+        with mock.patch.object(main, "_sqs", return_value=sqs):
+            main._matcher().enqueue_documents([{"n": 0}, {"n": 1}])
+
+        retried = sqs.send_message_batch.call_args_list[1].kwargs["Entries"]
+        self.assertEqual([entry["Id"] for entry in retried], ["1"])
+
+    def test_send_batch_raises_sender_faults(self):
+        sqs = mock.Mock()
+        sqs.send_message_batch.return_value = {"Failed": [{"Id": "0", "SenderFault": True}]}
+        with mock.patch.object(main, "_sqs", return_value=sqs):
+            with self.assertRaises(ValueError):
+                main._matcher().enqueue_documents([{"n": 0}])
+        self.assertEqual(sqs.send_message_batch.call_count, 1)
+
+    def test_enqueue_splits_batches_by_payload_size(self):
+        sqs = mock.Mock()
+        sqs.send_message_batch.return_value = {"Successful": []}
+        documents = [{"n": n, "payload": "x" * 100 * 1024} for n in range(3)] + [{"n": n} for n in range(3, 15)]
+        with mock.patch.object(main, "_sqs", return_value=sqs):
+            main._matcher().enqueue_documents(documents)
+
+        batches = [call.kwargs["Entries"] for call in sqs.send_message_batch.call_args_list]
+        self.assertEqual([len(batch) for batch in batches], [2, 10, 3])
+        for batch in batches:
+            self.assertLessEqual(sum(len(entry["MessageBody"]) for entry in batch), main.SQS_BATCH_BYTES)
+        bodies = [json.loads(entry["MessageBody"]) for batch in batches for entry in batch]
+        self.assertEqual(bodies, documents)
+
+    def test_buffer_flush_raises_send_failures(self):
+        sqs = mock.Mock()
+        sqs.send_message_batch.side_effect = [
+            ClientError({"Error": {"Code": "AccessDenied", "Message": "denied"}}, "SendMessageBatch"),
+            {"Successful": [{"Id": "0"}]},
+        ]
+        matcher = main._matcher()
+        with mock.patch.object(main, "_sqs", return_value=sqs):
+            matcher.enqueue_document({"n": 0})
+            with self.assertRaises(RuntimeError) as raised:
+                matcher._sqs_buffer.flush()
+            self.assertIsInstance(raised.exception.__cause__, ClientError)
+
+            # Failures are reported once, and later batches are unaffected
+            matcher.enqueue_document({"n": 1})
+            matcher._sqs_buffer.flush()
+
+
+if __name__ == "__main__":
+    unittest.main()